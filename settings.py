@@ -13,4 +13,10 @@ ABC = {
     'h': 8,
     'i': 9,
     'j': 0
-}
\ No newline at end of file
+}
+
+# Догоняющие запуски после простоя и корректная остановка
+MISFIRE_CATCHUP_WINDOW = 3 * 60 * 60  # секунды
+MISFIRE_CATCHUP_MAX_RUNS = 1
+MISFIRE_CATCHUP_CONCURRENCY = 2
+SHUTDOWN_DRAIN_TIMEOUT = 30  # секунды
@@ -4,9 +4,10 @@ from telegram.ext import Application, CommandHandler, CallbackQueryHandler, Mess
 from telegram.request import HTTPXRequest
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from settings import TOKEN, API_HASH, API_ID, ABC
+from settings import TOKEN, API_HASH, API_ID, ABC, MISFIRE_CATCHUP_WINDOW, MISFIRE_CATCHUP_MAX_RUNS, MISFIRE_CATCHUP_CONCURRENCY, SHUTDOWN_DRAIN_TIMEOUT
 from src.service import TelethonClientManager
-from src.database_models import db, User, Schedule
+from src.database_models import db, User, Schedule, ChatGroup, ScheduleChatGroup, Delivery, migrate_tables
+from src.database_executor import db_executor
 import json
 from datetime import datetime, timedelta
 import peewee
@@ -24,13 +25,14 @@ logging.info("Running Telegram Bot")
 
 class BotController:
     def __init__(self, token):
-        self.application = Application.builder().token(token).request(HTTPXRequest(connect_timeout=10, read_timeout=20)).build()
-        self.scheduler = AsyncIOScheduler()
+        self.application = Application.builder().token(token).request(HTTPXRequest(connect_timeout=10, read_timeout=20)).post_init(self.on_startup).post_shutdown(self.on_shutdown).build()
+        self.scheduler = AsyncIOScheduler(job_defaults={'coalesce': True, 'misfire_grace_time': MISFIRE_CATCHUP_WINDOW})
         self.scheduler.start()
         self.telethon_manager = TelethonClientManager(API_ID, API_HASH, self.scheduler)
         self.chats_per_page = 5
-        db.connect()
-        db.create_tables([User, Schedule])
+        db_executor.call(db.create_tables, [User, Schedule, ChatGroup, ScheduleChatGroup, Delivery])
+        db_executor.call(migrate_tables)
+        self.catch_up_task = None
 
         message_handler = MessageHandler(
             filters=(
@@ -49,13 +51,66 @@ class BotController:
     def run(self):
         self.application.run_polling()
 
+    async def on_startup(self, application: Application) -> None:
+        self.telethon_manager.set_chat_bot_id(application.bot.id)
+        schedules = await self.reload_scheduler()
+        self.catch_up_task = asyncio.create_task(self.catch_up(schedules))
+
+    async def on_shutdown(self, application: Application) -> None:
+        # Новые запуски не принимаем, текущие рассылки дожидаемся или сохраняем.
+        # shutdown планировщика отменяет его корутины, поэтому вызываем его только после ожидания
+        self.scheduler.pause()
+        await self.telethon_manager.drain_deliveries(SHUTDOWN_DRAIN_TIMEOUT)
+        self.scheduler.shutdown(wait=False)
+        # Догоняющие запуски, которые ещё не начались, просто отменяем
+        if self.catch_up_task and not self.catch_up_task.done():
+            self.catch_up_task.cancel()
+            await asyncio.gather(self.catch_up_task, return_exceptions=True)
+        await self.telethon_manager.disconnect_clients()
+        db_executor.shutdown()
+
+    @staticmethod
+    def missed_runs(schedule, now):
+        if MISFIRE_CATCHUP_MAX_RUNS <= 0:
+            return []
+        start = now - timedelta(seconds=MISFIRE_CATCHUP_WINDOW)
+        if schedule.last_run is not None:
+            start = max(schedule.last_run, start)
+        run_time = datetime.combine(start.date(), schedule.scheduled_time.time())
+        if run_time <= start:
+            run_time += timedelta(days=1)
+        runs = []
+        while run_time <= now:
+            runs.append(run_time)
+            run_time += timedelta(days=1)
+        return runs[-MISFIRE_CATCHUP_MAX_RUNS:]
+
+    async def catch_up(self, schedules):
+        semaphore = asyncio.Semaphore(MISFIRE_CATCHUP_CONCURRENCY)
+        jobs = [
+            (self.telethon_manager.run_delivery, delivery)
+            for delivery in await self.telethon_manager.load_interrupted_deliveries()
+        ]
+        now = datetime.now()
+        for schedule in schedules:
+            for run_time in self.missed_runs(schedule, now):
+                logging.info(f'Догоняющий запуск расписания {schedule.id} за {run_time}')
+                jobs.append((self.telethon_manager.send_scheduled_message, schedule.user_id, schedule.message, json.loads(schedule.chats), schedule.id))
+
+        async def run_job(func, *args):
+            async with semaphore:
+                await func(*args)
+
+        await asyncio.gather(*[run_job(*job) for job in jobs], return_exceptions=True)
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        context.user_data.pop('chat_search_step', None)
+        context.user_data.pop('group_step', None)
         await self.display_main_menu(update.message)
 
     async def delete_schedule(self, query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, schedule_id: int) -> None:
         try:
-            schedule = Schedule.get_by_id(schedule_id)
-            schedule.delete_instance()
+            await db_executor.run(lambda: Schedule.get_by_id(schedule_id).delete_instance(recursive=True))
             self.scheduler.remove_job(f'schedule_{schedule_id}')
             await query.edit_message_text(f'Расписание {schedule_id} успешно удалено.')
         except peewee.DoesNotExist:
@@ -68,14 +123,17 @@ class BotController:
 
     async def show_schedule_details(self, query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, schedule_id: int) -> None:
         try:
-            schedule = Schedule.get_by_id(schedule_id)
+            schedule = await db_executor.run(Schedule.get_by_id, schedule_id)
             chat_titles = await self.telethon_manager.get_chat_titles(query.from_user.id, json.loads(schedule.chats))
             chat_titles_str = ', '.join([title for chat_id, title in chat_titles.items()])
+            groups = await db_executor.run(lambda: list(ChatGroup.select().join(ScheduleChatGroup).where(ScheduleChatGroup.schedule == schedule.id)))
+            group_names_str = ', '.join([group.name for group in groups]) or '—'
             context.user_data['edit_schedule_id'] = schedule_id
             message = (f'Расписание ID: {schedule.id}\n'
                     f'Время: {schedule.scheduled_time}\n'
                     f'Сообщение: {schedule.message}\n'
-                    f'Чаты: {chat_titles_str}')
+                    f'Чаты: {chat_titles_str}\n'
+                    f'Группы чатов: {group_names_str}')
 
             keyboard = [
                 [InlineKeyboardButton("Редактировать время", callback_data=f'edit_time_{schedule.id}')],
@@ -111,7 +169,12 @@ class BotController:
             context.user_data['preferences'] = False
             context.user_data['edit_step'] = 'chats'
             context.user_data['current_page'] = 0
-            context.user_data['selected_chats'] = []
+            context.user_data['selected_chats'] = set()
+            context.user_data['selected_groups'] = set()
+            context.user_data.pop('chat_search_query', None)
+            context.user_data.pop('chat_search_step', None)
+            context.user_data.pop('group_step', None)
+            await self.telethon_manager.get_chats(user_id)
             await query.edit_message_text('Выберите новые чаты')
             await self.handle_edit(update, context)
 
@@ -132,7 +195,7 @@ class BotController:
         
         elif data.startswith('schedule_'):
             schedule_id = data.split('_')[1]
-            schedule = Schedule.get_by_id(schedule_id)
+            schedule = await db_executor.run(Schedule.get_by_id, schedule_id)
             chat_titles = await self.telethon_manager.get_chat_titles(user_id, json.loads(schedule.chats))
             chat_titles_str = ', '.join([title for chat_id, title in chat_titles.items()])
 
@@ -154,12 +217,29 @@ class BotController:
         elif query.data == 'next_page':
             context.user_data['current_page'] = context.user_data.get('current_page', 0) + 1
             await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
+        elif query.data == 'search_chats':
+            context.user_data['chat_search_step'] = True
+            await query.edit_message_text('Введите название чата для поиска:')
+        elif query.data == 'reset_chat_search':
+            context.user_data.pop('chat_search_query', None)
+            context.user_data.pop('chat_search_step', None)
+            context.user_data['current_page'] = 0
+            await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
+        elif query.data == 'select_found_chats':
+            found_chats = await self.telethon_manager.search_chats(user_id, context.user_data.get('chat_search_query', ''))
+            context.user_data['selected_chats'].update(chat.id for chat in found_chats)
+            context.user_data.pop('chat_search_query', None)
+            context.user_data['current_page'] = 0
+            await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
         elif query.data == 'back':
             print(context.user_data.get('preferences'))
+            context.user_data.pop('chat_search_query', None)
+            context.user_data.pop('chat_search_step', None)
+            context.user_data.pop('group_step', None)
             if not context.user_data.get('preferences'):
                 schedule = context.user_data['current_schedule']
-                schedule.chats = context.user_data['selected_chats']
-                schedule.save()
+                schedule.chats = json.dumps(list(context.user_data['selected_chats']))
+                await db_executor.run(self.save_schedule_chats, schedule, context.user_data.get('selected_groups', set()))
                 await query.message.reply_text('Чаты изменены')
                 context.user_data['preferences'] = True
             await self.display_main_menu(query)
@@ -175,20 +255,40 @@ class BotController:
             if user_id not in self.telethon_manager.clients:
                 await query.edit_message_text('Пожалуйста, сначала авторизуйтесь с помощью кнопки "Авторизация".')
             else:
-                context.user_data['selected_chats'] = []
+                context.user_data['selected_chats'] = set()
+                context.user_data['selected_groups'] = set()
                 context.user_data['preferences'] = True
+                context.user_data['current_page'] = 0
+                context.user_data.pop('chat_search_query', None)
+                context.user_data.pop('chat_search_step', None)
+                context.user_data.pop('group_step', None)
+                await self.telethon_manager.get_chats(user_id)
                 await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
         elif query.data.startswith('select_chat_'):
             chat_id = int(query.data.split('_')[-1])
-            if chat_id not in context.user_data['selected_chats']:
-                context.user_data['selected_chats'].append(chat_id)
+            context.user_data['selected_chats'].add(chat_id)
+            await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
+        elif query.data.startswith('unselect_chat_'):
+            chat_id = int(query.data.split('_')[-1])
+            context.user_data['selected_chats'].discard(chat_id)
+            await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
+        elif query.data.startswith('select_group_'):
+            group_id = int(query.data.split('_')[-1])
+            if await db_executor.run(lambda: ChatGroup.select().where((ChatGroup.id == group_id) & (ChatGroup.user == user_id)).exists()):
+                context.user_data.setdefault('selected_groups', set()).add(group_id)
+            await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
+        elif query.data.startswith('unselect_group_'):
+            group_id = int(query.data.split('_')[-1])
+            context.user_data.setdefault('selected_groups', set()).discard(group_id)
             await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
 
         elif query.data == 'done_selecting_chats':
-            if not context.user_data.get('selected_chats'):
+            if not context.user_data.get('selected_chats') and not context.user_data.get('selected_groups'):
                 await query.edit_message_text('Пожалуйста, выберите хотя бы один чат.')
-                await self.display_chat_selection_menu(query, context)
+                await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
             else:
+                context.user_data.pop('chat_search_query', None)
+                context.user_data.pop('chat_search_step', None)
                 context.user_data['schedule_step'] = 'time'
                 await query.edit_message_text('Введите время в формате HH:MM через запятую.')
 
@@ -202,6 +302,66 @@ class BotController:
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 await query.edit_message_text(f'Ваши чаты:\n{chat_list}', reply_markup=reply_markup)
 
+        elif query.data == 'show_groups':
+            await self.show_groups(query)
+
+        elif query.data == 'create_group':
+            if user_id not in self.telethon_manager.clients:
+                await query.edit_message_text('Пожалуйста, сначала авторизуйтесь с помощью кнопки "Авторизация".')
+            else:
+                context.user_data['group_step'] = 'name'
+                context.user_data['edit_group_id'] = None
+                context.user_data.pop('chat_search_query', None)
+                context.user_data.pop('chat_search_step', None)
+                await query.edit_message_text('Введите название группы чатов:')
+
+        elif query.data.startswith('chat_group_'):
+            group_id = int(query.data.split('_')[-1])
+            await self.show_group_details(query, group_id)
+
+        elif query.data.startswith('edit_group_'):
+            group_id = int(query.data.split('_')[-1])
+            try:
+                group = await db_executor.run(ChatGroup.get, (ChatGroup.id == group_id) & (ChatGroup.user == user_id))
+            except peewee.DoesNotExist:
+                await query.edit_message_text('Ошибка: Группа не найдена.')
+                return
+            context.user_data['group_step'] = 'chats'
+            context.user_data['edit_group_id'] = group_id
+            context.user_data['selected_chats'] = set(json.loads(group.chats))
+            context.user_data['preferences'] = True
+            context.user_data['current_page'] = 0
+            context.user_data.pop('chat_search_query', None)
+            context.user_data.pop('chat_search_step', None)
+            await self.telethon_manager.get_chats(user_id)
+            await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
+
+        elif query.data == 'done_group_chats':
+            if not context.user_data.get('selected_chats'):
+                await query.edit_message_text('Пожалуйста, выберите хотя бы один чат.')
+                await self.display_chat_selection_menu(query, context, preferences=context.user_data.get('preferences'))
+            else:
+                chats = json.dumps(list(context.user_data['selected_chats']))
+                group_id = context.user_data.get('edit_group_id')
+                if group_id:
+                    await db_executor.run(lambda: ChatGroup.update(chats=chats).where((ChatGroup.id == group_id) & (ChatGroup.user == user_id)).execute())
+                else:
+                    await db_executor.run(ChatGroup.create, user=user_id, name=context.user_data['group_name'], chats=chats)
+                context.user_data.pop('group_step', None)
+                context.user_data.pop('group_name', None)
+                context.user_data.pop('chat_search_query', None)
+                context.user_data.pop('chat_search_step', None)
+                del context.user_data['selected_chats']
+                await self.show_groups(query)
+
+        elif query.data.startswith('delete_group_'):
+            group_id = int(query.data.split('_')[-1])
+            try:
+                await db_executor.run(lambda: ChatGroup.get((ChatGroup.id == group_id) & (ChatGroup.user == user_id)).delete_instance(recursive=True))
+            except peewee.DoesNotExist:
+                pass
+            await self.show_groups(query)
+
         elif query.data == 'logout':
             print(user_id)
             keyboard = [[InlineKeyboardButton("Подтвердить", callback_data='confirm_logout')],
@@ -217,6 +377,46 @@ class BotController:
             if 'успешно' in response:
                 await self.display_main_menu(query)
 
+    @staticmethod
+    def save_schedule_chats(schedule, group_ids):
+        schedule.save()
+        ScheduleChatGroup.delete().where(ScheduleChatGroup.schedule == schedule.id).execute()
+        if group_ids:
+            ScheduleChatGroup.insert_many([{'schedule': schedule.id, 'group': group_id} for group_id in group_ids]).execute()
+
+    async def show_groups(self, query: CallbackQuery) -> None:
+        groups = await db_executor.run(lambda: list(ChatGroup.select().where(ChatGroup.user == query.from_user.id)))
+        keyboard = [
+            [InlineKeyboardButton(group.name, callback_data=f'chat_group_{group.id}')] for group in groups
+        ]
+        keyboard.append([InlineKeyboardButton("Создать группу", callback_data='create_group')])
+        keyboard.append([InlineKeyboardButton("Назад", callback_data='back')])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text('Ваши группы чатов:' if groups else 'У вас пока нет групп чатов.', reply_markup=reply_markup)
+
+    async def show_group_details(self, query: CallbackQuery, group_id: int) -> None:
+        try:
+            group = await db_executor.run(ChatGroup.get, (ChatGroup.id == group_id) & (ChatGroup.user == query.from_user.id))
+            chat_titles = await self.telethon_manager.get_chat_titles(query.from_user.id, json.loads(group.chats))
+            chat_titles_str = ', '.join([title for chat_id, title in chat_titles.items()])
+            schedules_count = await db_executor.run(group.schedules.count)
+            message = (f'Группа: {group.name}\n'
+                    f'Чаты: {chat_titles_str}\n'
+                    f'Используется в расписаниях: {schedules_count}')
+
+            keyboard = [
+                [InlineKeyboardButton("Редактировать чаты", callback_data=f'edit_group_{group.id}')],
+                [InlineKeyboardButton("Удалить группу", callback_data=f'delete_group_{group.id}')],
+                [InlineKeyboardButton("Назад", callback_data='show_groups')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await query.edit_message_text(message, reply_markup=reply_markup)
+        except peewee.DoesNotExist:
+            await query.edit_message_text('Ошибка: Группа не найдена.')
+        except Exception as e:
+            logging.error(f'Ошибка при показе группы чатов: {e}')
+            await query.edit_message_text('Ошибка при показе группы чатов. Попробуйте снова.')
+
     async def navigate_schedules_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         query = update.callback_query
         data = query.data
@@ -236,7 +436,7 @@ class BotController:
         # Параметры для постраничного вывода
         schedules_per_page = 5
 
-        schedules = Schedule.select().where(Schedule.user_id == user_id)
+        schedules = await db_executor.run(lambda: list(Schedule.select().where(Schedule.user_id == user_id)))
         total_schedules = len(schedules)
 
         # Определяем начало и конец текущей страницы
@@ -298,12 +498,10 @@ class BotController:
                     times = text.split(',')
                     scheduled_times = [datetime.strptime(time.strip(), '%H:%M').time() for time in times]
                     context.user_data['new_time'] = scheduled_times
-                    schedule = Schedule.get(Schedule.id == schedule_id)
                     new_scheduled_time = datetime.combine(datetime.today(), scheduled_times[0])
                     if new_scheduled_time < datetime.now():
                         new_scheduled_time += timedelta(days=1)
-                    schedule.scheduled_time = new_scheduled_time
-                    schedule.save()
+                    await db_executor.run(lambda: Schedule.update(scheduled_time=new_scheduled_time).where(Schedule.id == schedule_id).execute())
                     await update.message.reply_text('Время успешно изменено.')
                     await self.display_main_menu(update.message)
                 except Exception as e:
@@ -317,16 +515,16 @@ class BotController:
                     return
                 id = await self.telethon_manager.get_message(user_id)
                 context.user_data['new_message'] = id
-                schedule = Schedule.get(Schedule.id == schedule_id)
-                schedule.message = id
-                schedule.save()
+                await db_executor.run(lambda: Schedule.update(message=id).where(Schedule.id == schedule_id).execute())
                 await update.message.reply_text('Сообщение успешно изменено.')
                 await self.display_main_menu(update.message)
 
             elif edit_step == 'chats':
-                context.user_data['selected_chats'] = context.user_data.get('selected_chats', [])
+                context.user_data['selected_chats'] = context.user_data.get('selected_chats', set())
                 context.user_data['preferences'] = False
-                schedule = Schedule.get(Schedule.id==schedule_id)
+                schedule = await db_executor.run(Schedule.get, Schedule.id == schedule_id)
+                group_ids = await db_executor.run(lambda: [link.group_id for link in ScheduleChatGroup.select().where(ScheduleChatGroup.schedule == schedule.id)])
+                context.user_data['selected_groups'] = set(group_ids)
                 context.user_data['current_schedule'] = schedule
                 await self.display_chat_selection_menu(update.callback_query, context, context.user_data['preferences'])    
 
@@ -348,6 +546,23 @@ class BotController:
                 if 'успешно' in response:
                     del context.user_data['auth_step']
                     await self.display_main_menu(update.message)
+            elif context.user_data.get('group_step') == 'name':
+                name = (text or '').strip()
+                if not name:
+                    await update.message.reply_text('Название группы не может быть пустым. Введите название группы чатов:')
+                    return
+                context.user_data['group_name'] = name
+                context.user_data['group_step'] = 'chats'
+                context.user_data['selected_chats'] = set()
+                context.user_data['preferences'] = True
+                context.user_data['current_page'] = 0
+                await self.telethon_manager.get_chats(user_id)
+                await self.display_chat_selection_menu(update.message, context, preferences=context.user_data.get('preferences'))
+            elif 'chat_search_step' in context.user_data:
+                del context.user_data['chat_search_step']
+                context.user_data['chat_search_query'] = text or ''
+                context.user_data['current_page'] = 0
+                await self.display_chat_selection_menu(update.message, context, preferences=context.user_data.get('preferences'))
             elif 'schedule_step' in context.user_data:
                 await self.handle_schedule(update, context)
             elif 'edit_step' in context.user_data:
@@ -395,41 +610,47 @@ class BotController:
             elif context.user_data['schedule_step'] == 'message':
                 message = await self.telethon_manager.get_message(user_id)
                 chat_ids = context.user_data['selected_chats']
+                group_ids = context.user_data.get('selected_groups', set())
                 times = context.user_data['times']
-                await self.telethon_manager.schedule_message(user_id, message, times, chat_ids)
+                await self.telethon_manager.schedule_message(user_id, message, times, chat_ids, group_ids)
                 await update.message.reply_text('Расписание создано успешно.')
                 await self.display_main_menu(message=update.message)
                 del context.user_data['schedule_step']
                 del context.user_data['selected_chats']
+                context.user_data.pop('selected_groups', None)
                 del context.user_data['times']
 
-    def reload_scheduler(self):
+    @staticmethod
+    def load_schedules():
+        schedules = list(Schedule.select())
+        for schedule in schedules:
+            if schedule.scheduled_time < datetime.now():
+                schedule.scheduled_time += timedelta(days=1)
+                schedule.save()
+        return schedules
+
+    async def reload_scheduler(self):
+        schedules = await db_executor.run(self.load_schedules)
         self.scheduler.remove_all_jobs()
-        
-        schedules = Schedule.select()
+
         for schedule in schedules:
             scheduled_time = schedule.scheduled_time
-            if scheduled_time < datetime.now():
-                scheduled_time += timedelta(days=1)
-                schedule.scheduled_time = scheduled_time
-                schedule.save()
             job = self.scheduler.add_job(
                 self.telethon_manager.send_scheduled_message,
                 CronTrigger(hour=scheduled_time.hour, minute=scheduled_time.minute, second=0, jitter=30),
-                args=[schedule.user.user_id, schedule.message, json.loads(schedule.chats)],
-                coalesce=False,
+                args=[schedule.user_id, schedule.message, json.loads(schedule.chats), schedule.id],
                 id=f'schedule_{schedule.id}'
             )
 
         self.scheduler.add_job(
             self.reload_scheduler,
             CronTrigger(hour=0, minute=0, second=0),
-            id='daily_display_main_menu',
-            coalesce=False
+            id='daily_display_main_menu'
         )
         # print(self.scheduler._jobstores)
         # print(self.scheduler._job_defaults)
         print(self.scheduler.get_jobs())
+        return schedules
 
     async def display_main_menu(self, message):
         user_id = message.from_user.id if hasattr(message, 'from_user') else message.message.from_user.id
@@ -437,6 +658,7 @@ class BotController:
             [InlineKeyboardButton("Создать расписание", callback_data='create_schedule')],
             [InlineKeyboardButton("Показать чаты", callback_data='show_chats')],
             [InlineKeyboardButton("Показать расписание", callback_data='show_schedules')],
+            [InlineKeyboardButton("Группы чатов", callback_data='show_groups')],
             [InlineKeyboardButton("Выйти из аккаунта", callback_data='logout')]
         ] if user_id in self.telethon_manager.clients else [
             [InlineKeyboardButton("Авторизация", callback_data='authorize')],
@@ -448,7 +670,7 @@ class BotController:
         if user_id in self.telethon_manager.clients:
             self.telethon_manager.set_chat_bot_id(self.application.bot.id)
 
-        self.reload_scheduler()
+        await self.reload_scheduler()
 
         if hasattr(message, 'edit_message_text'):
             await message.edit_message_text('Привет! Я твой бот-контроллер. Пожалуйста, авторизуйтесь и настройте расписание.', reply_markup=reply_markup)
@@ -458,30 +680,59 @@ class BotController:
     async def display_chat_selection_menu(self, message, context, preferences: bool) -> None:
         print(preferences)
         user_id = message.from_user.id if isinstance(message, Message) or isinstance(message, CallbackQuery) else message.message.from_user.id
-        chats = await self.telethon_manager.get_chats(user_id)
-        selected_chats = context.user_data.get('selected_chats', [])
+        search_query = context.user_data.get('chat_search_query')
+        if search_query:
+            chats = await self.telethon_manager.search_chats(user_id, search_query)
+        else:
+            chats = await self.telethon_manager.get_cached_chats(user_id)
+        selected_chats = context.user_data.get('selected_chats', set())
+        selected_groups = context.user_data.get('selected_groups', set())
+        group_step = context.user_data.get('group_step')
         current_page = context.user_data.get('current_page', 0)
         start = current_page * self.chats_per_page
         end = start + self.chats_per_page
 
         unselected_chats = [chat for chat in chats if chat.id not in selected_chats]
-        page_chats = unselected_chats[start:end]
-
-        keyboard = [
+        # При редактировании группы показываем и выбранные чаты, чтобы их можно было убрать
+        listed_chats = chats if group_step else unselected_chats
+        page_chats = listed_chats[start:end]
+
+        keyboard = []
+        if not group_step and not search_query and current_page == 0:
+            groups = await db_executor.run(lambda: list(ChatGroup.select().where(ChatGroup.user == user_id)))
+            keyboard += [
+                [InlineKeyboardButton(f'✅ Группа: {group.name}', callback_data=f'unselect_group_{group.id}')] if group.id in selected_groups else
+                [InlineKeyboardButton(f'Группа: {group.name}', callback_data=f'select_group_{group.id}')] for group in groups
+            ]
+        keyboard += [
+            [InlineKeyboardButton(f'✅ {chat.title}', callback_data=f'unselect_chat_{chat.id}')] if chat.id in selected_chats else
             [InlineKeyboardButton(chat.title, callback_data=f'select_chat_{chat.id}')] for chat in page_chats
         ]
         if current_page > 0:
             keyboard.append([InlineKeyboardButton("Предыдущая страница", callback_data='prev_page')])
-        if end < len(unselected_chats):
+        if end < len(listed_chats):
             keyboard.append([InlineKeyboardButton("Следующая страница", callback_data='next_page')])
 
+        if search_query:
+            if unselected_chats:
+                keyboard.append([InlineKeyboardButton("Выбрать все найденные", callback_data='select_found_chats')])
+            keyboard.append([InlineKeyboardButton("Сбросить поиск", callback_data='reset_chat_search')])
+        else:
+            keyboard.append([InlineKeyboardButton("Поиск", callback_data='search_chats')])
         keyboard.append([InlineKeyboardButton("Назад", callback_data='back')])
-        keyboard.append([InlineKeyboardButton("Готово", callback_data='done_selecting_chats' if preferences else f'back')])
+        if group_step:
+            done_callback = 'done_group_chats'
+        else:
+            done_callback = 'done_selecting_chats' if preferences else f'back'
+        keyboard.append([InlineKeyboardButton("Готово", callback_data=done_callback)])
         reply_markup = InlineKeyboardMarkup(keyboard)
+        text = f'Результаты поиска «{search_query}»:' if search_query else 'Выберите чаты для отправки сообщений:'
+        if search_query and not page_chats:
+            text = f'По запросу «{search_query}» ничего не найдено.'
         try:
             if isinstance(message, CallbackQuery):
-                await message.edit_message_text('Выберите чаты для отправки сообщений:', reply_markup=reply_markup)
+                await message.edit_message_text(text, reply_markup=reply_markup)
             elif isinstance(message, Message):
-                await message.reply_text('Выберите чаты для отправки сообщений:', reply_markup=reply_markup)
+                await message.reply_text(text, reply_markup=reply_markup)
         except telegram.error.BadRequest:
             pass
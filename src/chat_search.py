@@ -0,0 +1,53 @@
+import re
+import unicodedata
+from bisect import bisect_left
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+class ChatSearchIndex:
+    """Префиксный индекс по названиям диалогов пользователя."""
+
+    def __init__(self, dialogs):
+        self.order = {}
+        self.titles = {}
+        self.postings = {}
+        for position, dialog in enumerate(dialogs):
+            title = dialog.title or ''
+            self.order[dialog.id] = position
+            self.titles[dialog.id] = title
+            for token in self.tokenize(title):
+                self.postings.setdefault(token, set()).add(dialog.id)
+        self.tokens = sorted(self.postings)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        text = unicodedata.normalize('NFKC', text).casefold()
+        return text.replace('ё', 'е')
+
+    @classmethod
+    def tokenize(cls, text: str) -> list:
+        return TOKEN_RE.findall(cls.normalize(text))
+
+    def _prefix_matches(self, prefix: str) -> set:
+        matches = set()
+        position = bisect_left(self.tokens, prefix)
+        while position < len(self.tokens) and self.tokens[position].startswith(prefix):
+            matches |= self.postings[self.tokens[position]]
+            position += 1
+        return matches
+
+    def search(self, query: str, limit: int = None) -> list:
+        query_tokens = self.tokenize(query)
+        if not query_tokens:
+            return []
+
+        result = None
+        for token in sorted(query_tokens, key=len, reverse=True):
+            matches = self._prefix_matches(token)
+            result = matches if result is None else result & matches
+            if not result:
+                return []
+
+        chat_ids = sorted(result, key=self.order.__getitem__)
+        return chat_ids[:limit] if limit else chat_ids
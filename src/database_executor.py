@@ -0,0 +1,31 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from src.database_models import db
+
+
+class DatabaseExecutor:
+    """Выполняет запросы peewee вне event loop, в отдельном потоке."""
+
+    def __init__(self, database, max_workers=1):
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='database')
+
+    def _execute(self, func, args, kwargs):
+        # peewee хранит соединение в thread-local, так что у каждого потока пула оно своё
+        self.database.connect(reuse_if_open=True)
+        with self.database.atomic():
+            return func(*args, **kwargs)
+
+    def call(self, func, *args, **kwargs):
+        return self.executor.submit(self._execute, func, args, kwargs).result()
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._execute, func, args, kwargs)
+
+    def shutdown(self):
+        self.executor.submit(self.database.close).result()
+        self.executor.shutdown(wait=True)
+
+
+db_executor = DatabaseExecutor(db)
@@ -1,4 +1,5 @@
 from peewee import Model, CharField, IntegerField, TextField, DateTimeField, ForeignKeyField, SqliteDatabase
+from playhouse.migrate import SqliteMigrator, migrate
 from datetime import datetime
 
 db = SqliteDatabase('schedule.db')
@@ -16,3 +17,25 @@ class Schedule(BaseModel):
     message = TextField()
     scheduled_time = DateTimeField()
     chats = TextField()
+    last_run = DateTimeField(null=True)
+
+class ChatGroup(BaseModel):
+    user = ForeignKeyField(User, backref='chat_groups')
+    name = CharField()
+    chats = TextField()
+
+class ScheduleChatGroup(BaseModel):
+    schedule = ForeignKeyField(Schedule, backref='chat_groups')
+    group = ForeignKeyField(ChatGroup, backref='schedules')
+
+class Delivery(BaseModel):
+    schedule = ForeignKeyField(Schedule, backref='deliveries', null=True)
+    user = ForeignKeyField(User, backref='deliveries')
+    message = TextField()
+    chats = TextField()
+    started_at = DateTimeField(default=datetime.now)
+
+def migrate_tables():
+    columns = [column.name for column in db.get_columns(Schedule._meta.table_name)]
+    if 'last_run' not in columns:
+        migrate(SqliteMigrator(db).add_column(Schedule._meta.table_name, 'last_run', Schedule.last_run))
@@ -3,14 +3,16 @@ import json
 import logging
 from telethon import TelegramClient, errors
 from telethon.sessions import StringSession
-from src.database_models import User, Schedule
+from src.database_models import User, Schedule, ChatGroup, ScheduleChatGroup, Delivery
+from src.chat_search import ChatSearchIndex
+from src.database_executor import db_executor
 from datetime import datetime, timedelta
 from apscheduler.triggers.cron import CronTrigger
 from settings import ABC
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import telethon
 import asyncio
-import time
+import uuid
 
 class TelethonClientManager:
     bot_id: int
@@ -19,6 +21,12 @@ class TelethonClientManager:
         self.api_hash = api_hash
         self.clients = {}
         self.auth_states = {}
+        self.dialogs = {}
+        self.dialogs_by_id = {}
+        self.search_indexes = {}
+        self.deliveries = set()
+        self.client_locks = {}
+        self.accepting_jobs = True
         self.scheduler: AsyncIOScheduler = scheduler
         self.session_file = 'sessions.json'
         self.load_sessions()
@@ -31,6 +39,8 @@ class TelethonClientManager:
             with open(self.session_file, 'r') as f:
                 sessions = json.load(f)
                 for user_id, session_str in sessions.items():
+                    if int(user_id) in self.clients:
+                        continue
                     client = TelegramClient(StringSession(session_str), self.api_id, self.api_hash, system_version='4.16.30-vxCUSTOM')
                     self.clients[int(user_id)] = client
 
@@ -83,7 +93,7 @@ class TelethonClientManager:
                 self.clients[user_id] = client
                 del self.auth_states[user_id]
                 self.save_sessions()
-                User.get_or_create(user_id=user_id)
+                await db_executor.run(User.get_or_create, user_id=user_id)
                 return 'Вы успешно авторизовались!'
             except errors.SessionPasswordNeededError:
                 self.auth_states[user_id]['step'] = 'password'
@@ -100,7 +110,7 @@ class TelethonClientManager:
                 self.clients[user_id] = client
                 del self.auth_states[user_id]
                 self.save_sessions()
-                User.get_or_create(user_id=user_id)
+                await db_executor.run(User.get_or_create, user_id=user_id)
                 return 'Вы успешно авторизовались!'
             except Exception as e:
                 logging.error(f'Ошибка авторизации с паролем: {e}')
@@ -116,83 +126,194 @@ class TelethonClientManager:
                 await client.connect()
             await client.log_out()
             print(user_id)
-            User.get(User.user_id == user_id).delete_instance(recursive=True)
+            await db_executor.run(lambda: User.get(User.user_id == user_id).delete_instance(recursive=True))
             os.remove(self.session_file)
             del self.clients[user_id]
+            self.dialogs.pop(user_id, None)
+            self.dialogs_by_id.pop(user_id, None)
+            self.search_indexes.pop(user_id, None)
             return 'Вы успешно вышли из аккаунта.'
         except ConnectionError as e:
             logging.error(f'Ошибка подключения при выходе из аккаунта: {e}')
             return 'Произошла ошибка при выходе из аккаунта. Пожалуйста, попробуйте снова.'
     
-    async def get_message(self, user_id):
+    async def connect_client(self, user_id) -> TelegramClient:
+        # Клиент общий для рассылок и меню, поэтому держим одно соединение и не отключаемся после каждого вызова
         if user_id not in self.clients:
             self.load_sessions()
 
         client: TelegramClient = self.clients[user_id]
+        async with self.client_locks.setdefault(user_id, asyncio.Lock()):
+            if not client.is_connected():
+                await client.connect()
+        return client
 
-        async with client:
-            source_peer = await client.get_input_entity(int(self.bot_id))
-            msgs = await client.get_messages(source_peer, limit=2)  
-            return msgs[0].id
+    async def disconnect_clients(self):
+        for client in self.clients.values():
+            if client.is_connected():
+                await client.disconnect()
 
-    async def send_message(self, user_id, message_id, chats):
-        if user_id not in self.clients:
-            self.load_sessions()
+    async def get_message(self, user_id):
+        client = await self.connect_client(user_id)
+        source_peer = await client.get_input_entity(int(self.bot_id))
+        msgs = await client.get_messages(source_peer, limit=2)  
+        return msgs[0].id
 
-        client: TelegramClient = self.clients[user_id]
+    async def checkpoint_delivery(self, delivery, remaining_chats):
+        if delivery is None:
+            return
+        delivery.chats = json.dumps(remaining_chats)
+        await db_executor.run(delivery.save)
 
-        async with client:
-            source_peer = await client.get_input_entity(int(self.bot_id))
-            user = await client.get_me()
-
-            for target_chat_id in chats:
-                try:
-                    target_peer = await client.get_input_entity(int(target_chat_id))
-                except ValueError:
-                    continue
-                try:
-                    await client.forward_messages(target_peer, int(message_id), source_peer, drop_author=True)
-                    await client.send_message(user.id, f'Сообщение "{message_id}" было отправлено в чат {target_chat_id}')
-                except telethon.errors.rpcerrorlist.ChatAdminRequiredError:
-                    await client.send_message(user.id, f'Эта группа является каналом, и туда писать ты не можешь. Такие группы не нужно добавлять бро')
-                    continue
-                except telethon.errors.rpcerrorlist.FloodWaitError as ex:
-                    await client.send_message(user.id, f'Бот попал в флуд лист, отдохни часок +- ~ {ex}')
-                    return
-                time.sleep(60)
-            await client.send_message(user.id, f'Сообщение "{message_id}" было отправлено в чаты: {", ".join([str(chat_id) for chat_id in chats])}')
-
-    async def schedule_message(self, user_id, message, scheduled_times, chats):
+    async def send_message(self, user_id, message_id, chats, delivery=None) -> bool:
+        client = await self.connect_client(user_id)
+        source_peer = await client.get_input_entity(int(self.bot_id))
+        user = await client.get_me()
+
+        for index, target_chat_id in enumerate(chats):
+            try:
+                target_peer = await client.get_input_entity(int(target_chat_id))
+            except ValueError:
+                await self.checkpoint_delivery(delivery, chats[index + 1:])
+                continue
+            try:
+                await client.forward_messages(target_peer, int(message_id), source_peer, drop_author=True)
+                await client.send_message(user.id, f'Сообщение "{message_id}" было отправлено в чат {target_chat_id}')
+            except telethon.errors.rpcerrorlist.ChatAdminRequiredError:
+                await client.send_message(user.id, f'Эта группа является каналом, и туда писать ты не можешь. Такие группы не нужно добавлять бро')
+                await self.checkpoint_delivery(delivery, chats[index + 1:])
+                continue
+            except telethon.errors.rpcerrorlist.FloodWaitError as ex:
+                await client.send_message(user.id, f'Бот попал в флуд лист, отдохни часок +- ~ {ex}')
+                return False
+            await self.checkpoint_delivery(delivery, chats[index + 1:])
+            await asyncio.sleep(60)
+        await client.send_message(user.id, f'Сообщение "{message_id}" было отправлено в чаты: {", ".join([str(chat_id) for chat_id in chats])}')
+        return True
+
+    @staticmethod
+    def create_schedules(user_id, message, scheduled_times, chats, group_ids):
         user, created = User.get_or_create(user_id=user_id)
+        schedule_ids = []
         for time in scheduled_times:
             scheduled_datetime = datetime.combine(datetime.today(), time)
             if scheduled_datetime < datetime.now():
                 scheduled_datetime += timedelta(days=1)
-            job = self.scheduler.add_job(self.send_scheduled_message, CronTrigger(hour=time.hour, minute=time.minute, second=0, jitter=60), args=[user_id, message, chats], coalesce=False)
-            Schedule.create(id=job.id, user=user, message=message, scheduled_time=scheduled_datetime, chats=json.dumps(chats))
+            schedule = Schedule.create(id=uuid.uuid4().hex, user=user, message=message, scheduled_time=scheduled_datetime, chats=json.dumps(chats))
+            if group_ids:
+                ScheduleChatGroup.insert_many([{'schedule': schedule.id, 'group': group_id} for group_id in group_ids]).execute()
+            schedule_ids.append(schedule.id)
+        return schedule_ids
+
+    async def schedule_message(self, user_id, message, scheduled_times, chats, group_ids=()):
+        chats = list(chats)
+        schedule_ids = await db_executor.run(self.create_schedules, user_id, message, scheduled_times, chats, list(group_ids))
+        for time, schedule_id in zip(scheduled_times, schedule_ids):
+            self.scheduler.add_job(self.send_scheduled_message, CronTrigger(hour=time.hour, minute=time.minute, second=0, jitter=60), args=[user_id, message, chats, schedule_id], id=f'schedule_{schedule_id}')
         return 'Сообщение успешно запланировано.'
 
+    @staticmethod
+    def resolve_schedule_chats(schedule_id, chats):
+        groups = (ChatGroup
+                  .select()
+                  .join(ScheduleChatGroup)
+                  .where(ScheduleChatGroup.schedule == schedule_id))
+        resolved = list(chats)
+        seen = set(resolved)
+        for group in groups:
+            for chat_id in json.loads(group.chats):
+                if chat_id not in seen:
+                    seen.add(chat_id)
+                    resolved.append(chat_id)
+        return resolved
+
     async def get_chats(self, user_id):
-        if user_id not in self.clients:
-            self.load_sessions()
+        client = await self.connect_client(user_id)
+        dialogs = await client.get_dialogs()
+        self.dialogs[user_id] = dialogs
+        self.dialogs_by_id[user_id] = {dialog.id: dialog for dialog in dialogs}
+        self.search_indexes[user_id] = ChatSearchIndex(dialogs)
+        return dialogs
+
+    async def get_cached_chats(self, user_id, refresh=False):
+        if refresh or user_id not in self.dialogs:
+            return await self.get_chats(user_id)
+        return self.dialogs[user_id]
 
-        client = self.clients[user_id]
-        async with client:
-            dialogs = await client.get_dialogs()
-            return dialogs
+    async def search_chats(self, user_id, query, limit=None):
+        if user_id not in self.search_indexes:
+            await self.get_chats(user_id)
+        chat_ids = self.search_indexes[user_id].search(query, limit)
+        dialogs = self.dialogs_by_id[user_id]
+        return [dialogs[chat_id] for chat_id in chat_ids]
 
     async def get_chat_titles(self, user_id, chat_ids):
         if user_id not in self.clients:
             raise ValueError("User not authorized")
 
-        client = self.clients[user_id]
+        client = await self.connect_client(user_id)
         titles = {}
-        async with client:
-            dialogs = await client.get_dialogs()
-            chat_map = {dialog.id: dialog.title for dialog in dialogs if dialog.id in chat_ids}
-            for chat_id in chat_ids:
-                titles[chat_id] = chat_map.get(chat_id, f"Чат с ID {chat_id} (не найден)")
+        dialogs = await client.get_dialogs()
+        chat_map = {dialog.id: dialog.title for dialog in dialogs if dialog.id in chat_ids}
+        for chat_id in chat_ids:
+            titles[chat_id] = chat_map.get(chat_id, f"Чат с ID {chat_id} (не найден)")
         return titles
     
-    async def send_scheduled_message(self, user_id, message, chats):
-        await self.send_message(user_id, message, chats)
+    @staticmethod
+    def start_delivery(user_id, message, chats, schedule_id):
+        if schedule_id is not None:
+            Schedule.update(last_run=datetime.now()).where(Schedule.id == schedule_id).execute()
+        return Delivery.create(schedule=schedule_id, user=user_id, message=message, chats=json.dumps(chats))
+
+    async def send_scheduled_message(self, user_id, message, chats, schedule_id=None):
+        if not self.accepting_jobs:
+            return
+        task = asyncio.current_task()
+        self.deliveries.add(task)
+        try:
+            if schedule_id is not None:
+                chats = await db_executor.run(self.resolve_schedule_chats, schedule_id, chats)
+            delivery = await db_executor.run(self.start_delivery, user_id, message, chats, schedule_id)
+            await self.deliver(delivery)
+        finally:
+            self.deliveries.discard(task)
+
+    async def run_delivery(self, delivery):
+        if not self.accepting_jobs:
+            return
+        task = asyncio.current_task()
+        self.deliveries.add(task)
+        try:
+            await self.deliver(delivery)
+        finally:
+            self.deliveries.discard(task)
+
+    async def deliver(self, delivery):
+        # Запись удаляем только после полной рассылки, иначе оставшиеся чаты дошлём при следующем запуске
+        try:
+            completed = await self.send_message(delivery.user_id, delivery.message, json.loads(delivery.chats), delivery)
+        except ConnectionError as e:
+            logging.error(f'Обрыв соединения при рассылке сообщения {delivery.message}: {e}')
+            return
+        except Exception as e:
+            logging.error(f'Ошибка при рассылке сообщения {delivery.message}: {e}')
+            return
+        if completed:
+            await db_executor.run(delivery.delete_instance)
+
+    async def load_interrupted_deliveries(self):
+        deliveries = await db_executor.run(lambda: list(Delivery.select()))
+        if deliveries:
+            logging.info(f'Возобновление прерванных рассылок: {len(deliveries)}')
+        return deliveries
+
+    async def drain_deliveries(self, timeout):
+        self.accepting_jobs = False
+        if not self.deliveries:
+            return
+        done, pending = await asyncio.wait(set(self.deliveries), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logging.warning(f'Не успели завершиться рассылки: {len(pending)}, они будут продолжены при следующем запуске')